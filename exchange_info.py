@@ -1,95 +1,141 @@
 import pytz, re
-from datetime import datetime, time as dttime
+from datetime import datetime, date, timedelta, time as dttime
+from dateutil.easter import easter
 
 trading_exchange_timezone = pytz.timezone('US/Eastern')
 exchange_opening_time = dttime(hour=9, minute = 30)
 exchange_normal_close_time = dttime(hour=16)
 exchange_early_close_time = dttime(hour=13)
-trading_holidays = ( #US Exchanges
-    #We record back to 2010 because we can request up to 5yrs of historical data
-    ('1/1/2010', 'full day'), 
-    ('1/18/2010', 'full day'), 
-    ('2/15/2010', 'full day'), 
-    ('4/4/2010', 'full day'), 
-    ('5/31/2010', 'full day'), 
-    ('7/5/2010', 'full day'), 
-    ('9/6/2010', 'full day'), 
-    ('11/25/2010', 'full day'), 
-    ('11/26/2010', 'early close'), 
-    ('12/24/2010', 'full day'),  
+#One-off closures that no rule predicts (national days of mourning, weather).
+#Regular holidays and early closes are generated by us_exchange_holidays().
+special_closures = ( #US Exchanges
+    ('6/11/2004', 'full day'), #President Reagan's funeral
+    ('1/2/2007', 'full day'), #President Ford's funeral
+    ('10/29/2012', 'full day'), #Hurricane Sandy
+    ('10/30/2012', 'full day'), #Hurricane Sandy
+    ('12/5/2018', 'full day'), #President George H.W. Bush's funeral
+    ('1/9/2025', 'full day'), #President Carter's funeral
+)
+
+def _nth_weekday_of_month(year, month, weekday, n):
+    """
+    Args:
+        weekday (int): Monday = 0 ... Sunday = 6
+        n (int): 1 for the first such weekday of the month, 2 for the second,
+            etc.; -1 for the last
+    Returns:
+        datetime.date object
+    """
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday-first.weekday()) % 7 + (n-1)*7)
+    else:
+        last = date(year, month+1, 1)-timedelta(days=1) if month < 12 else \
+            date(year, 12, 31)
+        return last - timedelta(days=(last.weekday()-weekday) % 7)
+
+def _observed(holiday):
+    """
+    NYSE Rule 7.2: a holiday falling on a Saturday is observed on the Friday
+    before, one falling on a Sunday on the Monday after.
+    """
+    if holiday.weekday() == 5:
+        return holiday-timedelta(days=1)
+    elif holiday.weekday() == 6:
+        return holiday+timedelta(days=1)
+    return holiday
+
+def us_exchange_holidays(year):
+    """
+    Generates the NYSE/NASDAQ holidays and early closes of a year from the
+    exchanges' rules.
+    Args:
+        year (int): e.g. 2015
+    Returns:
+        list of 2-tuples: (datetime.date, 'full day' or 'early close')
+    """
+    holidays = []
+    
+    #New Year's Day: not observed on the Friday before when it's a Saturday,
+    #since that Friday belongs to the previous year
+    new_years_day = date(year, 1, 1)
+    if new_years_day.weekday() != 5:
+        holidays.append((_observed(new_years_day), 'full day'))
+    if year >= 1998: #Martin Luther King, Jr. Day
+        holidays.append((_nth_weekday_of_month(year, 1, 0, 3), 'full day'))
+    #Washington's Birthday
+    holidays.append((_nth_weekday_of_month(year, 2, 0, 3), 'full day'))
+    #Good Friday
+    holidays.append((easter(year)-timedelta(days=2), 'full day'))
+    #Memorial Day
+    holidays.append((_nth_weekday_of_month(year, 5, 0, -1), 'full day'))
+    if year >= 2022: #Juneteenth
+        holidays.append((_observed(date(year, 6, 19)), 'full day'))
     
-    ('1/17/2011', 'full day'), 
-    ('2/21/2011', 'full day'), 
-    ('4/22/2011', 'full day'), 
-    ('5/30/2011', 'full day'), 
-    ('7/4/2011', 'full day'), 
-    ('9/5/2011', 'full day'), 
-    ('11/24/2011', 'full day'), 
-    ('11/25/2011', 'early close'), 
-    ('12/26/2011','full day'), 
+    #Independence Day; when it falls Tuesday-Friday, the day before closes early
+    independence_day = date(year, 7, 4)
+    holidays.append((_observed(independence_day), 'full day'))
+    if 1 <= independence_day.weekday() <= 4:
+        holidays.append((date(year, 7, 3), 'early close'))
     
-    ('1/2/2012', 'full day'), 
-    ('1/16/2012', 'full day'), 
-    ('2/20/2012', 'full day'), 
-    ('4/6/2012', 'full day'), 
-    ('5/28/2012', 'full day'), 
-    ('7/3/2012', 'early close'), 
-    ('7/4/2012', 'full day'), 
-    ('9/3/2012', 'full day'), 
-    ('11/22/2012', 'full day'), 
-    ('11/23/2012', 'early close'), 
-    ('12/24/2012', 'early close'), 
-    ('12/25/2012','full day'), 
+    #Labor Day
+    holidays.append((_nth_weekday_of_month(year, 9, 0, 1), 'full day'))
+    #Thanksgiving; the day after closes early
+    thanksgiving = _nth_weekday_of_month(year, 11, 3, 4)
+    holidays.append((thanksgiving, 'full day'))
+    holidays.append((thanksgiving+timedelta(days=1), 'early close'))
     
-    ('1/1/2013', 'full day'), 
-    ('1/21/2013', 'full day'), 
-    ('2/18/2013', 'full day'), 
-    ('3/29/2013', 'full day'), 
-    ('5/27/2013', 'full day'), 
-    ('7/3/2013', 'early close'), 
-    ('7/4/2013', 'full day'), 
-    ('9/2/2013', 'full day'), 
-    ('11/28/2013', 'full day'), 
-    ('11/29/2013', 'early close'), 
-    ('12/24/2013', 'early close'), 
-    ('12/25/2013','full day'), 
+    #Christmas; Christmas Eve closes early when it falls Monday-Thursday
+    christmas = date(year, 12, 25)
+    holidays.append((_observed(christmas), 'full day'))
+    if date(year, 12, 24).weekday() <= 3:
+        holidays.append((date(year, 12, 24), 'early close'))
     
-    ('1/1/2014', 'full day'), 
-    ('1/20/2014', 'full day'), 
-    ('2/17/2014', 'full day'), 
-    ('4/18/2014', 'full day'), 
-    ('5/26/2014', 'full day'), 
-    ('7/3/2014', 'early close'), 
-    ('7/4/2014', 'full day'), 
-    ('9/1/2014', 'full day'), 
-    ('11/27/2014', 'full day'), 
-    ('11/28/2014', 'early close'), 
-    ('12/24/2014', 'early close'), 
-    ('12/25/2014','full day'), 
+    return holidays
+
+class TradingHolidayCalendar:
+    """
+    Trading holidays for any date range. Each year's holidays are generated
+    from the rules the first time a date in that year is looked up and are
+    then kept in a date -> holiday type dict, so lookups are a dict access
+    rather than a scan through a list.
+    """
     
-    ('1/1/2015', 'full day'), 
-    ('1/19/2015', 'full day'), 
-    ('2/16/2015', 'full day'), 
-    ('4/3/2015', 'full day'), 
-    ('5/25/2015', 'full day'), 
-    ('7/3/2015', 'full day'), 
-    ('9/7/2015', 'full day'), 
-    ('11/26/2015', 'full day'), 
-    ('11/27/2015', 'early close'), 
-    ('12/24/2015', 'early close'), 
-    ('12/25/2015', 'full day'), 
+    def __init__(self, holiday_rules=None, special_closures=()):
+        """
+        Args:
+            holiday_rules (function): takes a year (int) and returns that
+                year's holidays as a list of (datetime.date, 'full day' or
+                'early close') 2-tuples; defaults to us_exchange_holidays
+            special_closures (list/tuple): holidays no rule predicts, in the
+                format convert_trading_holiday_datestrings_into_date_objects()
+                takes; they override the rules on the same date
+        """
+        self.holiday_rules = holiday_rules or us_exchange_holidays
+        self.special_closures = \
+            convert_trading_holiday_datestrings_into_date_objects(
+            special_closures)
+        self.holiday_types_by_date = {}
+        self.compiled_years = set()
     
-    ('1/1/2016', 'full day'), 
-    ('1/18/2016', 'full day'), 
-    ('2/15/2016', 'full day'), 
-    ('3/25/2016', 'full day'), 
-    ('5/30/2016', 'full day'), 
-    ('7/3/2016', 'early close'), 
-    ('7/4/2016', 'full day'), 
-    ('9/5/2016', 'full day'), 
-    ('11/25/2016', 'early close'), 
-    ('12/26/2016', 'full day'), 
-)
+    def holiday_type(self, mydate):
+        """
+        Args:
+            mydate (datetime.date): any date
+        Returns:
+            'full day', 'early close', or None if mydate isn't a holiday
+        """
+        if mydate.year not in self.compiled_years:
+            self._compile_year(mydate.year)
+        return self.holiday_types_by_date.get(mydate)
+    
+    def _compile_year(self, year):
+        holiday_types_by_date = dict(self.holiday_rules(year))
+        for (closure_date, closure_type) in self.special_closures:
+            if closure_date.year == year:
+                holiday_types_by_date[closure_date] = closure_type
+        self.holiday_types_by_date.update(holiday_types_by_date)
+        self.compiled_years.add(year)
 
 def convert_trading_holiday_datestrings_into_date_objects(trading_holidays):
     """
@@ -123,5 +169,5 @@ def convert_trading_holiday_datestrings_into_date_objects(trading_holidays):
     
     return converted_trading_holidays
 
-trading_holidays = convert_trading_holiday_datestrings_into_date_objects(
-    trading_holidays)
\ No newline at end of file
+trading_holidays = TradingHolidayCalendar(us_exchange_holidays,
+    special_closures)
@@ -3,7 +3,7 @@ from datetime import datetime
 
 import exchange_info
 from myib import MyIb
-from security import Security
+from security import Security, ContractResolver
 
 def error_handler(msg):
     """Callback to 'Error' message."""
@@ -22,6 +22,8 @@ def main():
         exchange_info.exchange_opening_time, 
         exchange_info.exchange_normal_close_time, 
         exchange_info.exchange_early_close_time, exchange_info.trading_holidays)
+    contract_resolver = ContractResolver(my_ib)
+    Security.set_contract_resolver(contract_resolver)
     
     #create security object
     my_security = Security(my_ib, symbol='GOOG', secType='STK',
@@ -30,6 +32,10 @@ def main():
     #Register callbacks
     my_ib.conn.register(error_handler, 'Error')
     my_ib.conn.register(my_security.save_historical_data, 'HistoricalData')
+    my_ib.conn.register(contract_resolver.save_contract_details,
+        'ContractDetails')
+    my_ib.conn.register(contract_resolver.contract_details_end,
+        'ContractDetailsEnd')
     
     my_ib.connect_to_ib_servers()
     
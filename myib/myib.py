@@ -1,10 +1,15 @@
 import time, threading
+from collections import deque
 from ib.opt import Connection
 
 class MyIb:
     def __init__(self, port=7496, clientId=100):
         self.reqId = 0
+        self.reqId_lock = threading.Lock() #reqIds are generated from several
+            #threads
         self.conn = Connection.create(port=port, clientId=clientId)
+        #seconds each recent reqHistoricalData() took to complete
+        self.historical_request_latencies = deque(maxlen=200)
     
     def connect_to_ib_servers(self):
         """Blocks until successfully connected to IB."""
@@ -23,6 +28,25 @@ class MyIb:
         with the requested information, allowing you to keep track of which
         information corresponds to which request.
         '''
-        with threading.Lock():
+        with self.reqId_lock:
             self.reqId+=1
-            return self.reqId
\ No newline at end of file
+            return self.reqId
+    
+    def record_historical_request_latency(self, seconds):
+        self.historical_request_latencies.append(seconds)
+    
+    def historical_request_latency_percentile(self, percentile,
+        minimum_number_of_samples=20):
+        """
+        Args:
+            percentile (float): e.g. 95 for the 95th percentile
+            minimum_number_of_samples (int): below this many recorded
+                latencies the percentile isn't meaningful and None is returned
+        Returns:
+            the latency in seconds (float), or None
+        """
+        if len(self.historical_request_latencies) < minimum_number_of_samples:
+            return None
+        latencies = sorted(self.historical_request_latencies)
+        index = min(int(len(latencies)*percentile/100), len(latencies)-1)
+        return latencies[index]
\ No newline at end of file
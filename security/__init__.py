@@ -1,3 +1,8 @@
 from .security import Security #enables the syntax
     #'from security import Security' rather than
-    #'from security.security import Security'
\ No newline at end of file
+    #'from security.security import Security'
+from .sma_result import SmaResult
+from .shared_bar_cache import SharedBarCache
+from .contract_resolver import ContractResolver
+from .batch_compute import compute_indicators
+from .watchlist import SmaWatchlist
@@ -0,0 +1,233 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from . import helper_functions
+
+#One OHLCV bar as sent by IB. datetime is a datetime.date for day bars and a
+#timezone-aware datetime.datetime set to the exchange timezone otherwise.
+Bar = namedtuple('Bar', ['datetime', 'open', 'high', 'low', 'close', 'volume'])
+
+#intraday bar sizes accepted by reqHistoricalData(), finest first
+INTRADAY_BAR_SIZES = ('1 sec', '5 secs', '10 secs', '15 secs', '30 secs',
+    '1 min', '2 mins', '3 mins', '5 mins', '10 mins', '15 mins', '20 mins',
+    '30 mins', '1 hour')
+
+def get_ohlc_value(bar, ohlc):
+    """
+    Args:
+        bar (Bar): a Bar object
+        ohlc (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', or 'AVG' - 'AVG' takes the
+            high/low average
+    """
+    ohlc = ohlc.lower()
+    if ohlc == 'open':
+        return bar.open
+    elif ohlc == 'high':
+        return bar.high
+    elif ohlc == 'low':
+        return bar.low
+    elif ohlc == 'close':
+        return bar.close
+    elif ohlc == 'avg':
+        return (bar.high+bar.low)/2
+
+def bar_size_in_seconds(barSizeSetting):
+    """
+    Args:
+        barSizeSetting (str): '1 sec' or '5 mins' or '1 day', etc.
+    Returns:
+        the length of one bar in seconds (int), or None for day bars, whose
+        length depends on the trading session
+    """
+    barSizeSetting_value, barSizeSetting_type = \
+        helper_functions._parse_barSizeSetting(barSizeSetting)
+    if barSizeSetting_type in ('sec', 'secs'):
+        return barSizeSetting_value
+    elif barSizeSetting_type in ('min', 'mins'):
+        return barSizeSetting_value*60
+    elif barSizeSetting_type in ('hour', 'hours'):
+        return barSizeSetting_value*3600
+    else: #day
+        return None
+
+def can_resample(fine_barSizeSetting, coarse_barSizeSetting):
+    """
+    Returns True if bars of fine_barSizeSetting can be combined into bars of
+    coarse_barSizeSetting, i.e. the fine bars are intraday bars and every
+    coarse bar boundary is also a fine bar boundary.
+    """
+    fine_secs = bar_size_in_seconds(fine_barSizeSetting)
+    coarse_secs = bar_size_in_seconds(coarse_barSizeSetting)
+    if fine_secs is None: #day bars can't be broken back down
+        return False
+    if coarse_secs is None: #any intraday bars can be combined into days
+        return True
+    return coarse_secs % fine_secs == 0
+
+def session_bounds(d, trading_holidays, exchange_opening_time,
+    exchange_normal_close_time, exchange_early_close_time):
+    """
+    Args:
+        d (datetime.datetime): a timezone-aware datetime object set to the
+            exchange timezone
+        others: see Security.set_trading_exchange_information()
+    Returns:
+        2-tuple of timezone-aware datetimes: the opening and closing bell of
+        the trading session on d's date, or None if d's date isn't a trading
+        day
+    """
+    if not helper_functions._is_date_a_trading_day(d, trading_holidays):
+        return None
+    if helper_functions._is_date_a_trading_holiday(d, trading_holidays,
+        return_true_for_one_holiday_type_only='early close'):
+        close_time = exchange_early_close_time
+    else:
+        close_time = exchange_normal_close_time
+    session_open = d.tzinfo.localize(datetime.combine(d.date(),
+        exchange_opening_time))
+    session_close = d.tzinfo.localize(datetime.combine(d.date(), close_time))
+    return (session_open, session_close)
+
+def bar_start(d, bar_secs, session_open):
+    """
+    Returns the start of the bar that d falls in. Bars are laid on a grid
+    counted from midnight, like IB's own bars, and the first bar of the session
+    is clipped to the opening bell, e.g. with 1 hour bars and a 9:30 open the
+    first bar spans 9:30-10:00 and the second 10:00-11:00.
+    Args:
+        d (datetime.datetime): a timezone-aware datetime object set to the
+            exchange timezone
+        bar_secs (int): the bar length in seconds
+        session_open (datetime.datetime): opening bell of d's session
+    """
+    secs_since_midnight = d.hour*3600 + d.minute*60 + d.second
+    start = d.replace(microsecond=0) - timedelta(
+        seconds=secs_since_midnight % bar_secs)
+    return max(start, session_open)
+
+def next_bar_close(d, barSizeSetting, trading_holidays, exchange_opening_time,
+    exchange_normal_close_time, exchange_early_close_time):
+    """
+    Returns the time the next barSizeSetting bar closes after d, on the same
+    grid as bar_start(): bars close on the grid or at the closing bell,
+    whichever comes first, and day bars close at the closing bell. Weekends,
+    holidays and early closes are accounted for; outside of trading hours the
+    first bar close of the next session is returned.
+    Args:
+        d (datetime.datetime): a timezone-aware datetime object set to the
+            exchange timezone
+        barSizeSetting (str): '5 mins', '1 hour', '1 day', etc.
+        others: see Security.set_trading_exchange_information()
+    Returns:
+        datetime.datetime object set to the exchange timezone
+    """
+    bar_secs = bar_size_in_seconds(barSizeSetting)
+    day = d
+    while True:
+        bounds = session_bounds(day, trading_holidays, exchange_opening_time,
+            exchange_normal_close_time, exchange_early_close_time)
+        if bounds is not None and d < bounds[1]:
+            session_open, session_close = bounds
+            if bar_secs is None: #day bars
+                return session_close
+            t = max(d, session_open)
+            secs_since_midnight = t.hour*3600 + t.minute*60 + t.second
+            bar_close = t.replace(microsecond=0) + timedelta(
+                seconds=bar_secs - secs_since_midnight % bar_secs)
+            return min(bar_close, session_close)
+        day = d.tzinfo.localize(datetime.combine(day.date()+timedelta(days=1),
+            datetime.min.time())) #midnight of the next day
+
+def previous_bar_close(d, barSizeSetting, trading_holidays,
+    exchange_opening_time, exchange_normal_close_time,
+    exchange_early_close_time):
+    """
+    Returns the time the most recent barSizeSetting bar closed at or before d,
+    on the same grid as next_bar_close(). Outside of trading hours that's the
+    closing bell of the previous session.
+    Args:
+        see next_bar_close()
+    Returns:
+        datetime.datetime object set to the exchange timezone
+    """
+    bar_secs = bar_size_in_seconds(barSizeSetting)
+    day = d
+    while True:
+        bounds = session_bounds(day, trading_holidays, exchange_opening_time,
+            exchange_normal_close_time, exchange_early_close_time)
+        if bounds is not None and bounds[0] < d:
+            session_open, session_close = bounds
+            if d >= session_close:
+                return session_close
+            if bar_secs is not None:
+                secs_since_midnight = d.hour*3600 + d.minute*60 + d.second
+                bar_close = d.replace(microsecond=0) - timedelta(
+                    seconds=secs_since_midnight % bar_secs)
+                if bar_close > session_open:
+                    return bar_close
+            #no bar has closed yet in this session
+        day = d.tzinfo.localize(datetime.combine(day.date()-timedelta(days=1),
+            datetime.min.time())) #midnight of the previous day
+
+def bars_closed_by(bars, bar_close):
+    """
+    Returns the bars (list) that had closed by bar_close, a bar close as
+    returned by previous_bar_close(): intraday bars that started before it,
+    and day bars of the sessions up to its date.
+    Args:
+        bars (iterable): Bar objects
+        bar_close (datetime.datetime): timezone-aware
+    """
+    closed_bars = []
+    for bar in bars:
+        if isinstance(bar.datetime, datetime):
+            closed = bar.datetime < bar_close
+        else: #day bars
+            closed = bar.datetime <= bar_close.date()
+        if closed:
+            closed_bars.append(bar)
+    return closed_bars
+
+def resample_bars(bars, barSizeSetting, trading_holidays,
+    exchange_opening_time, exchange_normal_close_time,
+    exchange_early_close_time):
+    """
+    Builds coarser OHLCV bars out of finer ones, e.g. 5 min bars out of 1 min
+    bars. Coarse bars are aligned to the trading session: they never span two
+    sessions, the first bar of a session starts at the opening bell and the
+    last one ends at the (normal or early) closing bell. Fine bars that fall
+    outside of trading hours are dropped.
+    Args:
+        bars (iterable): intraday Bar objects sorted oldest first
+        barSizeSetting (str): the coarse bar size: '5 mins', '1 hour',
+            '1 day', etc.
+        others: see Security.set_trading_exchange_information()
+    Returns:
+        list of Bar objects, oldest first
+    """
+    coarse_secs = bar_size_in_seconds(barSizeSetting)
+    sessions = {} #date -> session_bounds() result; one lookup per day
+
+    def bucket(bar):
+        d = bar.datetime
+        if d.date() not in sessions:
+            sessions[d.date()] = session_bounds(d, trading_holidays,
+                exchange_opening_time, exchange_normal_close_time,
+                exchange_early_close_time)
+        bounds = sessions[d.date()]
+        if bounds is None or not bounds[0] <= d < bounds[1]:
+            return None #outside of trading hours
+        if coarse_secs is None: #day bars
+            return d.date()
+        return bar_start(d, coarse_secs, bounds[0])
+
+    resampled_bars = []
+    for start, group in groupby(bars, key=bucket):
+        if start is None:
+            continue
+        group = list(group)
+        resampled_bars.append(Bar(start, group[0].open,
+            max(bar.high for bar in group), min(bar.low for bar in group),
+            group[-1].close, sum(bar.volume for bar in group)))
+    return resampled_bars
@@ -0,0 +1,206 @@
+import os, mmap
+from array import array
+from operator import attrgetter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from .shared_bar_cache import SharedBarSeries, HEADER_LENGTH, BAR_LENGTH, \
+    COLUMNS, segment_file_id
+
+def _sma(values, length):
+    """Simple moving average of the last length values"""
+    return sum(values[-length:])/length
+
+def _ema(values, length):
+    """
+    Exponential moving average over all of values, seeded with the SMA of the
+    first length values
+    """
+    alpha = 2/(length+1)
+    ema = sum(values[:length])/length
+    for value in values[length:]:
+        ema += alpha*(value-ema)
+    return ema
+
+#indicator name -> function(values, length); values is a memoryview of floats,
+#oldest first, holding at least length values
+INDICATORS = {
+    'sma': _sma,
+    'ema': _ema,
+}
+
+def compute_indicators(bar_series, indicator_specs, ohlc='CLOSE',
+    max_workers=None):
+    """
+    Computes indicators for many bar series at once, spreading the work over a
+    pool of processes that read the bar values from shared memory in place, so
+    nothing but a small per-chunk index is pickled. For the work to scale with
+    the number of cores, pass in series that are already in shared memory
+    (SharedBarSeries, which workers map directly) or already packed into
+    float arrays (copied into the shared block with one memcpy each); lists
+    of Bar objects have to be unpacked value by value in this process first.
+    Args:
+        bar_series (dict): key (e.g. a symbol) -> one of:
+            - a SharedBarSeries (see SharedBarCache.read()); raises an
+              Exception if the segment is rewritten before the workers map it
+            - an array('d') or float memoryview of the values, oldest first
+            - a list of Bar objects, oldest first
+        indicator_specs (list): list of (name, length) 2-tuples, e.g.
+            [('sma', 50), ('sma', 200), ('ema', 20)]; see INDICATORS for the
+            valid names
+        ohlc (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', or 'AVG' - the bar value
+            the indicators are computed over; ignored for pre-packed values
+        max_workers (int): number of worker processes; defaults to the number
+            of CPUs. Pass in 1 to compute in the calling process.
+    Returns:
+        dict: key -> {(name, length): indicator value (float)}, with name
+        lowercased; the value is None if the series holds fewer than length
+        bars
+    """
+    indicator_specs = [(name.lower(), length)
+        for (name, length) in indicator_specs]
+    for (name, length) in indicator_specs:
+        if name not in INDICATORS:
+            raise Exception("Invalid indicator: {}".format(name))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    ohlc = ohlc.lower()
+
+    #(key, segment or None for the shared block, start, count, stride) per
+    #series, where segment is the (path, file id) of the SharedBarSeries'
+    #file; series that aren't in shared memory yet are packed end to end into
+    #the shared block
+    keys = list(bar_series)
+    index = []
+    values_to_pack = []
+    packed_length = 0
+    for i, key in enumerate(keys):
+        series = bar_series[key]
+        if isinstance(series, SharedBarSeries) and series.path is not None \
+            and ohlc != 'avg':
+            index.append((i, (series.path, series.file_id),
+                HEADER_LENGTH+COLUMNS[ohlc], series.count, BAR_LENGTH))
+            continue
+        values = _pack_values(series, ohlc)
+        index.append((i, None, packed_length, len(values), 1))
+        values_to_pack.append(values)
+        packed_length += len(values)
+
+    shm = shared_memory.SharedMemory(create=True,
+        size=max(packed_length, 1)*8)
+    try:
+        #released even if packing fails, or shm.close() would raise over it
+        with shm.buf.cast('d') as shared_values:
+            offset = 0
+            for values in values_to_pack:
+                shared_values[offset:offset+len(values)] = values
+                offset += len(values)
+        del values_to_pack
+
+        if max_workers == 1:
+            chunk_results = [_compute_chunk(shm.name, index, indicator_specs)]
+        else:
+            chunks = _split_index_into_chunks(index, max_workers*4)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                chunk_results = list(executor.map(_compute_chunk,
+                    [shm.name]*len(chunks), chunks,
+                    [indicator_specs]*len(chunks)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results = {}
+    for chunk_result in chunk_results:
+        for (i, indicator_values) in chunk_result:
+            results[keys[i]] = indicator_values
+    return results
+
+def _pack_values(series, ohlc):
+    """
+    Returns the series' values as a contiguous float buffer (array('d') or
+    memoryview); pre-packed values are returned as they are
+    """
+    if isinstance(series, SharedBarSeries):
+        if ohlc == 'avg': #'AVG' isn't stored in the segment
+            return array('d', ((high+low)/2 for (high, low) in
+                zip(series.column('HIGH'), series.column('LOW'))))
+        return array('d', series.column(ohlc)) #a segment without a path
+    if isinstance(series, (array, memoryview)):
+        if isinstance(series, array):
+            format, ndim = series.typecode, 1
+        else:
+            format, ndim = series.format, series.ndim
+        if format != 'd' or ndim != 1:
+            raise Exception("Pre-packed values must be a 1-dimensional buffer "
+                "of doubles ('d'), not a {}-dimensional buffer of '{}'".format(
+                ndim, format))
+        return series
+    if ohlc == 'avg':
+        return array('d', [(bar.high+bar.low)/2 for bar in series])
+    return array('d', map(attrgetter(ohlc), series))
+
+def _split_index_into_chunks(index, number_of_chunks):
+    """
+    Splits the index into chunks holding roughly the same number of values,
+    so that every worker gets about the same amount of work no matter how
+    uneven the series lengths are.
+    """
+    total_values = sum(entry[3] for entry in index)
+    values_per_chunk = max(total_values//number_of_chunks, 1)
+    chunks = []
+    chunk = []
+    running_count_of_values = 0
+    for entry in index:
+        chunk.append(entry)
+        running_count_of_values += entry[3]
+        if running_count_of_values >= values_per_chunk:
+            chunks.append(chunk)
+            chunk = []
+            running_count_of_values = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def _compute_chunk(shm_name, chunk, indicator_specs):
+    """
+    Runs in a worker process. Attaches to the shared memory block and to the
+    shared bar segments the chunk refers to, and computes every indicator for
+    every series in chunk. A segment that was rewritten since the calling
+    process read it raises an Exception: its bar count came from the old
+    file, so it can't be used to read the new one.
+    Returns:
+        list of (key, {(name, length): value}) 2-tuples
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = {None: shm.buf.cast('d')} #segment -> float memoryview
+    mms = []
+    try:
+        chunk_results = []
+        for (i, segment, start, count, stride) in chunk:
+            if segment not in buffers:
+                path, file_id = segment
+                with open(path, 'rb') as f:
+                    if segment_file_id(f) != file_id:
+                        raise Exception("The shared bar segment {} was "
+                            "rewritten after it was read; read it again and "
+                            "retry".format(path))
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                mms.append(mm)
+                buffers[segment] = memoryview(mm).cast('d')
+            series = buffers[segment][start:start+count*stride:stride] #a view
+            indicator_values = {}
+            for (name, length) in indicator_specs:
+                if count < length:
+                    indicator_values[(name, length)] = None
+                else:
+                    indicator_values[(name, length)] = INDICATORS[name](series,
+                        length)
+            series.release()
+            chunk_results.append((i, indicator_values))
+        return chunk_results
+    finally:
+        for buffer in buffers.values():
+            buffer.release()
+        for mm in mms:
+            mm.close()
+        shm.close()
@@ -0,0 +1,140 @@
+import os, time, json, atexit, threading
+
+class ContractResolver:
+    """
+    Looks up each Security's contract with reqContractDetails() once and
+    remembers the resolved conId and primary exchange, in memory and in a JSON
+    file on disk, until they expire. Securities then send conId-pinned
+    contracts, which IB doesn't have to resolve again and which can't be
+    ambiguous.
+    Register save_contract_details() and contract_details_end() as the
+    'ContractDetails' and 'ContractDetailsEnd' callbacks.
+    """
+
+    def __init__(self, my_ib, cache_path='~/.ibpy_contract_cache.json',
+        expiry_secs=7*24*3600, timeout=10, flush_every=50):
+        """
+        Args:
+            my_ib (MyIb): a MyIb object defined in this Python package
+            cache_path (str): JSON file the resolved contracts are kept in
+                between runs; None to keep them in memory only
+            expiry_secs (float): how long a resolved contract is trusted
+            timeout (float): seconds to wait for IB's contract details
+            flush_every (int): new resolutions are written to cache_path
+                every flush_every resolutions, and when the process exits
+        """
+        self.my_ib = my_ib
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else \
+            None
+        self.expiry_secs = expiry_secs
+        self.timeout = timeout
+        self.resolved_contracts = {} #key -> [conId, primaryExch, resolved at]
+        self.contract_details_by_reqId = {}
+        self.finished_reqIds = set()
+        self.lock = threading.Lock()
+        self.flush_every = flush_every
+        self.unsaved_resolutions = 0
+        if self.cache_path is not None:
+            self.resolved_contracts = self._load_from_disk()
+            atexit.register(self.flush)
+
+    def resolve(self, security):
+        """
+        Args:
+            security (Security): the Security to resolve
+        Returns:
+            2-tuple: (conId (int), primaryExch (str))
+        """
+        key = '|'.join(str(field) for field in security.cache_key())
+        with self.lock:
+            resolved = self.resolved_contracts.get(key)
+        if resolved is not None and \
+            time.time()-resolved[2] < self.expiry_secs:
+            return (resolved[0], resolved[1])
+
+        summary = self._request_contract_summary(security)
+        with self.lock:
+            self.resolved_contracts[key] = [summary.m_conId,
+                summary.m_primaryExch, time.time()]
+            self.unsaved_resolutions += 1
+            flush = self.unsaved_resolutions >= self.flush_every
+        if flush:
+            self.flush()
+        return (summary.m_conId, summary.m_primaryExch)
+
+    def _request_contract_summary(self, security):
+        """
+        Sends reqContractDetails() for security's unpinned contract and picks
+        the matching contract out of IB's answer.
+        Returns:
+            the resolved ib.ext.Contract
+        """
+        reqId = self.my_ib.generate_new_reqId()
+        self.contract_details_by_reqId[reqId] = []
+        try:
+            self.my_ib.conn.reqContractDetails(reqId,
+                security._create_security_contract())
+            start_time = time.time()
+            while reqId not in self.finished_reqIds:
+                if time.time()-start_time >= self.timeout:
+                    raise TimeoutError("IB didn't send the contract details "
+                        "for {} within {} seconds".format(security.symbol,
+                        self.timeout))
+                time.sleep(0.05)
+            summaries = [details.m_summary for details in
+                self.contract_details_by_reqId[reqId]]
+        finally:
+            del self.contract_details_by_reqId[reqId]
+            self.finished_reqIds.discard(reqId)
+
+        matching_summaries = summaries
+        if security.primaryExch is not None:
+            matching_summaries = [summary for summary in summaries
+                if summary.m_primaryExch == security.primaryExch]
+        if len(matching_summaries) != 1:
+            raise Exception("{} of the contracts IB returned for {} match; set "
+                "primaryExch to one of {} to resolve the ambiguity".format(
+                len(matching_summaries), security.symbol,
+                [summary.m_primaryExch for summary in summaries]))
+        return matching_summaries[0]
+
+    def _load_from_disk(self):
+        """Returns the resolved contracts saved in cache_path (dict)"""
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError): #missing or half-written
+            return {}
+
+    def flush(self):
+        """
+        Writes the resolved contracts to cache_path. Other processes may have
+        saved contracts to the same file since it was read, so the file's
+        current contents are merged in first, keeping the more recent
+        resolution of each contract.
+        """
+        if self.cache_path is None:
+            return
+        with self.lock:
+            if self.unsaved_resolutions == 0:
+                return
+            for key, resolved in self._load_from_disk().items():
+                if key not in self.resolved_contracts or \
+                    self.resolved_contracts[key][2] < resolved[2]:
+                    self.resolved_contracts[key] = resolved
+            temp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(self.resolved_contracts, f)
+            os.replace(temp_path, self.cache_path)
+            self.unsaved_resolutions = 0
+
+    def save_contract_details(self, msg):
+        """Callback to reqContractDetails()"""
+        if msg.reqId in self.contract_details_by_reqId:
+            self.contract_details_by_reqId[msg.reqId].append(
+                msg.contractDetails)
+
+    def contract_details_end(self, msg):
+        """Callback to reqContractDetails(); IB has sent all the details"""
+        if msg.reqId in self.contract_details_by_reqId:
+            self.finished_reqIds.add(msg.reqId)
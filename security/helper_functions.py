@@ -1,9 +1,12 @@
-import re
+import re, logging
+from itertools import islice
 from operator import itemgetter
 from datetime import datetime, timedelta, date as dtdate
 import dateutil.relativedelta as relativedelta
 import tzlocal
 
+from .sma_result import SmaResult
+
 def format_endDateTime(endDateTime, trading_exchange_timezone):
     """
     The date string passed into the endDateTime arg of reqHistoricalData()
@@ -87,7 +90,8 @@ def calculate_durationStr(length, barSizeSetting, endDateTime, trading_holidays,
             SMA, etc.
         endDateTime (datetime): a timezone-aware datetime object set to
             trading_exchange_timezone
-        trading_holidays (list): a list of 2-tuples, e.g.
+        trading_holidays (TradingHolidayCalendar or list): an
+            exchange_info.TradingHolidayCalendar, or a list of 2-tuples, e.g.
             (datetime.date, 'full day'/'early close')
         others: self-explanatory
     Returns:
@@ -152,7 +156,7 @@ def fix_barSizeSetting_cruft(barSizeSetting):
         return barSizeSetting
 
 def calculate_historical_sma(length, historical_values, startDateTime,
-    endDateTime):
+    endDateTime, logger=None):
     """
     Args:
         length (int): e.g. the 30 in '30-day SMA'
@@ -160,11 +164,15 @@ def calculate_historical_sma(length, historical_values, startDateTime,
         subtuple.
             item 1: datetime.datetime (or datetime.date if durationStr is days);
             item 2: historical data (float)
+        startDateTime (datetime.datetime): start of the historical info span
+        endDateTime (datetime.datetime): end of the historical info span
+        logger (logging.Logger): optional; if passed in, each bar used in the
+            calculation is logged at debug level
+    Returns:
+        SmaResult object
     """
     #sort list of tuples by datetime (1st item), newest first
     historical_values.sort(key=itemgetter(0), reverse=True)
-    #filter out historical values before the startDateTime
-    historical_values = historical_values[:length]
 
     if len(historical_values) < length:
         list_of_values_for_error_msg = ''
@@ -177,14 +185,32 @@ def calculate_historical_sma(length, historical_values, startDateTime,
                 len(historical_values), list_of_values_for_error_msg)
         raise IndexError(error_message)
     
-    #print historical values
-    for historical_value in historical_values:
-        print("historicalData date={} value={}".format(historical_value[0],
-            historical_value[1]))
+    #only the first length values are used, so there's no need to slice off
+    #(and copy) the values before the startDateTime
+    log_historical_values(logger, historical_values, length)
     
-    return sum([t[1] for t in historical_values])/len(historical_values) #SMA
+    sma = sum(t[1] for t in islice(historical_values, length))/length
+    return SmaResult(sma, length, startDateTime, endDateTime, historical_values)
 
+def log_historical_values(logger, historical_values, length):
+    """
+    Logs the first length (datetime, value) 2-tuples of historical_values at
+    debug level; does nothing if logger is None or debug is disabled.
+    """
+    if logger is not None and logger.isEnabledFor(logging.DEBUG):
+        for historical_value in islice(historical_values, length):
+            logger.debug("historicalData date=%s value=%s",
+                historical_value[0], historical_value[1])
 
+def _localize(d, timezone):
+    """
+    Attaches timezone to the naive datetime d. pytz timezones must be attached
+    with localize() to get the right UTC offset; other tzinfo objects can
+    simply be set.
+    """
+    if hasattr(timezone, 'localize'):
+        return timezone.localize(d)
+    return d.replace(tzinfo=timezone)
 
 def _calculate_start_datetime_of_historical_request(length, barSizeSetting,
     endDateTime, trading_holidays, trading_exchange_timezone,
@@ -367,15 +393,7 @@ def _is_date_a_trading_day(mydate, trading_holidays):
     if myweekday == 5 or myweekday == 6: #If the date passed in is a Sat or Sun
         return False
     else:
-        if isinstance(mydate, datetime): #convert datetime to date
-            mydate = mydate.date()
-        for holiday in trading_holidays:
-            if mydate == holiday[0]: #if the date passed in is a trading holiday
-                if holiday[1] == 'full day':
-                    return False
-                else:
-                    return True
-        else: return True
+        return _get_holiday_type(mydate, trading_holidays) != 'full day'
 
 def _is_date_a_trading_holiday(mydate, trading_holidays,
     return_true_for_one_holiday_type_only=False):
@@ -390,18 +408,31 @@ def _is_date_a_trading_holiday(mydate, trading_holidays,
     Returns:
         True or False (bool)
     """
+    holiday_type = _get_holiday_type(mydate, trading_holidays)
+    if holiday_type is None:
+        return False
+    if return_true_for_one_holiday_type_only == False:
+        return True
+    return holiday_type == return_true_for_one_holiday_type_only
+
+def _get_holiday_type(mydate, trading_holidays):
+    """
+    Args:
+        mydate (datetime.datetime or datetime.date): the date to check
+        trading_holidays (TradingHolidayCalendar or list): an
+            exchange_info.TradingHolidayCalendar, or a list of 2-tuples, e.g.
+            (datetime.date, 'full day')
+    Returns:
+        'full day', 'early close', or None if mydate isn't a trading holiday
+    """
     if isinstance(mydate, datetime): #convert datetime to date
         mydate = mydate.date()
+    if hasattr(trading_holidays, 'holiday_type'): #a TradingHolidayCalendar
+        return trading_holidays.holiday_type(mydate)
     for holiday in trading_holidays:
         if mydate == holiday[0]:
-            if return_true_for_one_holiday_type_only == False:
-                return True
-            else:
-                if holiday[1] == return_true_for_one_holiday_type_only:
-                    return True
-                else:
-                    return False
-    else: return False
+            return holiday[1]
+    return None
 
 def _does_datetime_fall_during_trading_hours(d, trading_holidays,
     exchange_opening_time, exchange_normal_close_time,
@@ -1,11 +1,18 @@
-import time, re
+import time, re, threading
 from datetime import datetime, timedelta
 import dateutil.relativedelta as relativedelta
+from operator import itemgetter
 import tzlocal
 
 from ib.ext.Contract import Contract
 
 from . import helper_functions
+from . import bars as bars_module
+from .sma_result import SmaResult
+
+#IB treats identical historical data requests within this many seconds of
+#each other as a pacing violation
+IDENTICAL_REQUEST_PACING_SECS = 15
 
 class Security:
     """
@@ -16,6 +23,9 @@ class Security:
     vague as 'Measurable'.
     """
     
+    shared_bar_cache = None #see set_shared_bar_cache()
+    contract_resolver = None #see set_contract_resolver()
+    
     @classmethod
     def set_trading_exchange_information(cls, trading_exchange_timezone,
         exchange_opening_time, exchange_normal_close_time,
@@ -26,6 +36,25 @@ class Security:
         cls.exchange_early_close_time = exchange_early_close_time
         cls.trading_holidays = trading_holidays
     
+    @classmethod
+    def set_shared_bar_cache(cls, shared_bar_cache):
+        """
+        Args:
+            shared_bar_cache (SharedBarCache): bars downloaded by any Security
+                are written to it (unless it's read-only), and every Security
+                looks for bars in it before requesting them from IB
+        """
+        cls.shared_bar_cache = shared_bar_cache
+    
+    @classmethod
+    def set_contract_resolver(cls, contract_resolver):
+        """
+        Args:
+            contract_resolver (ContractResolver): if set, every Security's
+                contract is resolved once and then pinned to its conId
+        """
+        cls.contract_resolver = contract_resolver
+    
     def __init__(self, my_ib, symbol, secType, exchange, primaryExch=None,
         currency='USD'):
         """
@@ -51,6 +80,14 @@ class Security:
         self.primaryExch = primaryExch
         self.currency = currency
         self.contract = self._create_security_contract()
+        self.bar_cache = {} #(barSizeSetting, whatToShow) -> (startDateTime,
+            #endDateTime, bars); see cache_bars()
+        self.historical_bars_by_reqId = {} #bars of outstanding requests
+        self.finished_historical_reqIds = set()
+        self.historical_requests_sent = 0 #requests that reached IB rather
+            #than being served from a cache
+        self.historical_data_lock = threading.Lock() #the IbPy reader thread
+            #calls save_historical_data()
     
     def _create_security_contract(self):
         """To pass into IB messages"""
@@ -62,9 +99,26 @@ class Security:
             contract.m_primaryExch = self.primaryExch
         contract.m_currency = self.currency
         return contract
+    
+    def _get_contract(self):
+        """
+        Returns the contract to pass into IB messages, pinned to its conId once
+        the contract resolver has resolved it
+        """
+        if self.contract_resolver is not None and not self.contract.m_conId:
+            conId, primaryExch = self.contract_resolver.resolve(self)
+            self.contract.m_conId = conId
+            self.contract.m_primaryExch = primaryExch
+        return self.contract
+
+    def cache_key(self):
+        """Identifies this Security's contract in the shared bar cache"""
+        return (self.symbol, self.secType, self.exchange, self.primaryExch,
+            self.currency)
 
     def get_historical_sma(self, length, barSizeSetting, ohlc, whatToShow,
-        endDateTime='now'):
+        endDateTime='now', return_result=False, logger=None, timeout=None,
+        hedge_percentile=None):
         """
         Returns a historical SMA value. This has limits; for instance, you
         cannot reach back more than 1-5 years into the past (depending on
@@ -83,23 +137,36 @@ class Security:
                 trading exchange.
             ohlc (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', or 'AVG' - 'AVG' takes
                 the high/low average;
+            return_result (bool): if True, return an SmaResult object instead
+                of the bare SMA value
+            logger (logging.Logger): optional; if passed in, each bar used in
+                the calculation is logged at debug level
+            timeout (float): optional; seconds to wait for IB to send the
+                data. On expiry the request is cancelled with
+                cancelHistoricalData() and TimeoutError is raised.
+            hedge_percentile (float): optional, e.g. 95; if the request is
+                still outstanding after the 95th percentile of past request
+                latencies, it is sent a second time and whichever copy finishes
+                first is used. The second copy never goes out sooner than 15
+                seconds after the first, since IB rejects identical requests
+                within 15 seconds as pacing violations. No hedging until enough
+                requests have been timed.
             others: see interactivebrokers.com/en/software/api/apiguide/
                 java/reqhistoricaldata.htm
         Returns:
-            The historical SMA value (float)
+            The historical SMA value (float), or an SmaResult object if
+            return_result is True. Bars cached before endDateTime are used
+            only up to the last bar that had closed when they were fetched;
+            the SMA then covers the length bars ending at that bar close,
+            which is the SmaResult's window_end.
         """
         #set attrs used by self.save_historical_data()
-        self.ohlc = ohlc
         if 'day' in barSizeSetting:
             self.historicalReq_date_str_fmt = '%Y%m%d'
         else: #otherwise bars are < 1 day
             self.historicalReq_date_str_fmt = '%Y%m%d  %H:%M:%S' #2 spaces
                 #between day and hour
         
-        self.have_we_received_all_historical_data_from_ib = False
-        self.historical_data = []
-        
-        reqId = self.my_ib.generate_new_reqId()
         eDT_for_calculate_durationStr, eDT_for_reqHistoricalData = \
             helper_functions.format_endDateTime(endDateTime,
             self.trading_exchange_timezone)
@@ -108,40 +175,277 @@ class Security:
             self.trading_holidays, self.trading_exchange_timezone,
             self.exchange_opening_time, self.exchange_normal_close_time,
             self.exchange_early_close_time)
+        
+        if self.shared_bar_cache is not None:
+            result = self._get_sma_from_shared_cache(length, barSizeSetting,
+                ohlc, whatToShow, startDateTime, eDT_for_calculate_durationStr,
+                logger)
+            if result is not None:
+                return result if return_result else result.sma
+        
+        cached = self._get_bars_from_cache(length, barSizeSetting, whatToShow,
+            startDateTime, eDT_for_calculate_durationStr)
+        if cached is not None:
+            bars, window_end = cached
+        else: #nothing cached covers the window; ask IB
+            window_end = eDT_for_calculate_durationStr
+            bars = self._request_historical_bars(barSizeSetting, whatToShow,
+                durationStr, eDT_for_reqHistoricalData, timeout,
+                hedge_percentile)
+            self.cache_bars(barSizeSetting, whatToShow, bars, startDateTime,
+                eDT_for_calculate_durationStr)
+            if self.shared_bar_cache is not None and \
+                not self.shared_bar_cache.read_only:
+                self.shared_bar_cache.write(self.cache_key(), barSizeSetting,
+                    whatToShow, bars, startDateTime,
+                    eDT_for_calculate_durationStr)
+        self.historical_data = [(bar.datetime,
+            bars_module.get_ohlc_value(bar, ohlc)) for bar in bars]
+
+        result = helper_functions.calculate_historical_sma(length,
+            self.historical_data, startDateTime, window_end, logger)
+        return result if return_result else result.sma
+    
+    def cache_bars(self, barSizeSetting, whatToShow, bars, startDateTime,
+        endDateTime):
+        """
+        Keeps bars around so that later SMAs over the same or a coarser
+        barSizeSetting can be calculated locally rather than requested from IB.
+        Bars you already hold from elsewhere can be passed in here as well.
+        Args:
+            bars (list): Bar objects, oldest first, covering the whole span
+                from startDateTime to endDateTime
+            startDateTime, endDateTime (datetime.datetime): timezone-aware
+                datetimes set to the exchange timezone
+            others: see get_historical_sma()
+        """
+        key = (helper_functions._parse_barSizeSetting(barSizeSetting),
+            whatToShow)
+        self.bar_cache[key] = (startDateTime, endDateTime, bars)
+    
+    def _get_bars_from_cache(self, length, barSizeSetting, whatToShow,
+        startDateTime, endDateTime):
+        """
+        Looks for cached intraday bars that cover the span from startDateTime
+        to endDateTime and that can be resampled into barSizeSetting bars. The
+        coarsest such bars are used, since they're the fewest to resample. This
+        Security's own cache is checked first, then the shared bar cache.
+        Cached bars fetched before endDateTime are still used if they were
+        fetched at or after the close of the last barSizeSetting bar that
+        closed by endDateTime, e.g. for endDateTime='now'. The bar that was
+        still open when they were fetched is then left out, since it's missing
+        the trades made since, and only the bars closed by then are returned.
+        Returns:
+            2-tuple: (list of Bar objects, oldest first; the end of the span
+            they cover), or None if nothing cached holds length bars over the
+            span
+        """
+        last_bar_close = bars_module.previous_bar_close(endDateTime,
+            barSizeSetting, self.trading_holidays, self.exchange_opening_time,
+            self.exchange_normal_close_time, self.exchange_early_close_time)
+        candidates = []
+        for (parsed_barSizeSetting, cached_whatToShow), (cached_start,
+            cached_end, cached_bars) in self.bar_cache.items():
+            cached_barSizeSetting = '{} {}'.format(*parsed_barSizeSetting)
+            if cached_whatToShow != whatToShow:
+                continue
+            if not bars_module.can_resample(cached_barSizeSetting,
+                barSizeSetting):
+                continue
+            if cached_start > startDateTime or cached_end < last_bar_close:
+                continue
+            candidates.append((bars_module.bar_size_in_seconds(
+                cached_barSizeSetting), cached_start, cached_end, cached_bars))
+        if candidates:
+            cached_start, cached_end, cached_bars = max(candidates,
+                key=itemgetter(0))[1:]
+        elif self.shared_bar_cache is not None:
+            shared_bars = self._get_bars_from_shared_cache(barSizeSetting,
+                whatToShow, startDateTime, last_bar_close)
+            if shared_bars is None:
+                return None
+            cached_start, cached_end, cached_bars = shared_bars
+        else:
+            return None
+        
+        cached_bars = [bar for bar in cached_bars
+            if bar.datetime <= endDateTime]
+        resampled_bars = bars_module.resample_bars(cached_bars, barSizeSetting,
+            self.trading_holidays, self.exchange_opening_time,
+            self.exchange_normal_close_time, self.exchange_early_close_time)
+        #the oldest bar is incomplete if it started before the cached span
+        bars = [bar for bar in resampled_bars
+            if not isinstance(bar.datetime, datetime) or
+            bar.datetime >= cached_start]
+        window_end = endDateTime
+        if cached_end < endDateTime: #the newest bar was still open
+            bars = bars_module.bars_closed_by(bars, last_bar_close)
+            window_end = last_bar_close
+        if len(bars) < length:
+            return None
+        return (bars, window_end)
+    
+    def _get_sma_from_shared_cache(self, length, barSizeSetting, ohlc,
+        whatToShow, startDateTime, endDateTime, logger):
+        """
+        Calculates the SMA straight out of a shared segment of exactly
+        barSizeSetting bars (day bars included), without copying the bars. The
+        segment is used if it's current up to the last closed bar, and then
+        only its closed bars are; see _get_bars_from_cache().
+        Returns:
+            an SmaResult object, or None if there is no such segment
+        """
+        series = self.shared_bar_cache.read(self.cache_key(), barSizeSetting,
+            whatToShow, self.trading_exchange_timezone)
+        if series is None:
+            return None
+        last_bar_close = bars_module.previous_bar_close(endDateTime,
+            barSizeSetting, self.trading_holidays, self.exchange_opening_time,
+            self.exchange_normal_close_time, self.exchange_early_close_time)
+        window_end = bars_end = endDateTime
+        if series.covered_end < endDateTime: #the newest bar was still open
+            window_end = last_bar_close
+            #only the bars starting before the last bar close
+            bars_end = last_bar_close-timedelta(microseconds=1)
+        if series.covered_start > startDateTime or \
+            series.covered_end < last_bar_close or \
+            series.count_bars_until(bars_end) < length:
+            series.close()
+            return None
+        
+        #the view keeps the segment mapped for as long as the result lives
+        self.historical_data = series.historical_values(ohlc, bars_end)
+        sma = series.calculate_sma(length, ohlc, bars_end)
+        helper_functions.log_historical_values(logger, self.historical_data,
+            length)
+        return SmaResult(sma, length, startDateTime, window_end,
+            self.historical_data)
+    
+    def _get_bars_from_shared_cache(self, barSizeSetting, whatToShow,
+        startDateTime, last_bar_close):
+        """
+        Returns:
+            3-tuple: (start and end of the span the segment covers, list of
+            Bar objects) for the coarsest shared segment that covers the span
+            from startDateTime to last_bar_close and can be resampled into
+            barSizeSetting bars, or None if there is no such segment
+        """
+        for cached_barSizeSetting in reversed(bars_module.INTRADAY_BAR_SIZES):
+            if not bars_module.can_resample(cached_barSizeSetting,
+                barSizeSetting):
+                continue
+            series = self.shared_bar_cache.read(self.cache_key(),
+                cached_barSizeSetting, whatToShow,
+                self.trading_exchange_timezone)
+            if series is None:
+                continue
+            with series:
+                if series.covered_start <= startDateTime and \
+                    series.covered_end >= last_bar_close:
+                    return (series.covered_start, series.covered_end,
+                        series.bars())
+        return None
+    
+    def _request_historical_bars(self, barSizeSetting, whatToShow, durationStr,
+        endDateTime, timeout=None, hedge_percentile=None):
+        """
+        Sends reqHistoricalData() and blocks until IB has sent all the bars.
+        Args:
+            endDateTime (str): local-time-formatted date string, see
+                helper_functions.format_endDateTime()
+            others: see get_historical_sma()
+        Returns:
+            list of Bar objects, oldest first
+        """
         barSizeSetting = helper_functions.fix_barSizeSetting_cruft(
             barSizeSetting)
+        if hedge_percentile is not None:
+            hedge_after = self.my_ib.historical_request_latency_percentile(
+                hedge_percentile) #None until enough requests have been timed
+        else:
+            hedge_after = None
         
-        self.my_ib.conn.reqHistoricalData(reqId, self.contract,
-            endDateTime=eDT_for_reqHistoricalData, durationStr=durationStr,
+        if hedge_after is not None:
+            #IB counts an identical request within 15 secs as a pacing
+            #violation, so the hedge can't go out any sooner
+            hedge_after = max(hedge_after, IDENTICAL_REQUEST_PACING_SECS)
+        
+        #resolving the contract can block on IB too; it mustn't count towards
+        #the timeout or the recorded latency
+        contract = self._get_contract()
+        start_time = time.time()
+        reqIds = [self._send_reqHistoricalData(contract, barSizeSetting,
+            whatToShow, durationStr, endDateTime)]
+        try:
+            while True:
+                with self.historical_data_lock:
+                    finished_reqIds = [reqId for reqId in reqIds
+                        if reqId in self.finished_historical_reqIds]
+                    if finished_reqIds:
+                        bars = self.historical_bars_by_reqId[finished_reqIds[0]]
+                        break
+                elapsed = time.time()-start_time
+                if timeout is not None and elapsed >= timeout:
+                    #slow requests count towards the latency percentile too
+                    self.my_ib.record_historical_request_latency(elapsed)
+                    raise TimeoutError("IB didn't send the historical data for "
+                        "{} within {} seconds".format(self.symbol, timeout))
+                if hedge_after is not None and len(reqIds) == 1 and \
+                    elapsed >= hedge_after: #slow; send the request again
+                    reqIds.append(self._send_reqHistoricalData(contract,
+                        barSizeSetting, whatToShow, durationStr, endDateTime))
+                time.sleep(0.1)
+        finally:
+            #cancel whatever is still outstanding and stop listening for it
+            with self.historical_data_lock:
+                for reqId in reqIds:
+                    if reqId not in self.finished_historical_reqIds:
+                        self.my_ib.conn.cancelHistoricalData(reqId)
+                    self.finished_historical_reqIds.discard(reqId)
+                    del self.historical_bars_by_reqId[reqId]
+        
+        #measured from the first send, so a hedged request counts as slow
+        self.my_ib.record_historical_request_latency(time.time()-start_time)
+        return bars
+    
+    def _send_reqHistoricalData(self, contract, barSizeSetting, whatToShow,
+        durationStr, endDateTime):
+        """
+        Args:
+            contract (ib.ext.Contract): see _get_contract()
+        Returns:
+            the reqId of the request
+        """
+        reqId = self.my_ib.generate_new_reqId()
+        with self.historical_data_lock:
+            self.historical_bars_by_reqId[reqId] = []
+        self.historical_requests_sent += 1
+        self.my_ib.conn.reqHistoricalData(reqId, contract,
+            endDateTime=endDateTime, durationStr=durationStr,
             barSizeSetting=barSizeSetting, whatToShow=whatToShow, useRTH=1,
             formatDate=1)
-        while not self.have_we_received_all_historical_data_from_ib:
-            time.sleep(0.1)
-
-        return helper_functions.calculate_historical_sma(length,
-            self.historical_data, startDateTime, eDT_for_calculate_durationStr)
+        return reqId
     
     def save_historical_data(self, msg):
         """Callback to reqHistoricalData()"""
-        try:
-            self._save_historicalData_price(msg)
-        except ValueError as e: #will happen on final historicalData msg
-            if 'finished' in msg.date:
-                self.have_we_received_all_historical_data_from_ib = True
-            else: raise e
+        #held so a request can't be cleaned up between the check and the save
+        with self.historical_data_lock:
+            if msg.reqId not in self.historical_bars_by_reqId:
+                return #a cancelled request, or one meant for another Security
+            try:
+                self._save_historicalData_bar(msg)
+            except ValueError as e: #will happen on final historicalData msg
+                if 'finished' in msg.date:
+                    self.finished_historical_reqIds.add(msg.reqId)
+                else: raise e
     
-    def _save_historicalData_price(self, msg):
-        msg_dt = datetime.strptime(msg.date,
-            self.historicalReq_date_str_fmt).date() #convert string to date obj
-        ohlc = self.ohlc.lower()
-        if ohlc == 'open':
-            target_value = msg.open
-        elif ohlc == 'high':
-            target_value = msg.high
-        elif ohlc == 'low':
-            target_value = msg.low  
-        elif ohlc == 'close':
-            target_value = msg.close
-        elif ohlc == 'avg':
-            target_value = (msg.high+msg.low)/2  
-        self.historical_data.append((msg_dt, target_value))
\ No newline at end of file
+    def _save_historicalData_bar(self, msg):
+        msg_dt = datetime.strptime(msg.date, self.historicalReq_date_str_fmt)
+        if self.historicalReq_date_str_fmt == '%Y%m%d': #day bars
+            msg_dt = msg_dt.date() #convert string to date obj
+        else: #intraday bars are sent in local time
+            msg_dt = helper_functions._localize(msg_dt,
+                tzlocal.get_localzone()).astimezone(
+                self.trading_exchange_timezone)
+        self.historical_bars_by_reqId[msg.reqId].append(bars_module.Bar(msg_dt,
+            msg.open, msg.high, msg.low, msg.close, msg.volume))
@@ -0,0 +1,264 @@
+import os, mmap, hashlib, tempfile
+from array import array
+from datetime import datetime, date as dtdate
+
+from . import helper_functions
+from .bars import Bar
+
+#Each segment is a flat array of doubles: a header followed by one record per
+#bar. Day bars store their date as an ordinal, intraday bars as a timestamp.
+HEADER_LENGTH = 4 #bar count, covered start, covered end, day bars flag
+BAR_LENGTH = 6 #datetime, open, high, low, close, volume
+COLUMNS = {'datetime': 0, 'open': 1, 'high': 2, 'low': 3, 'close': 4,
+    'volume': 5}
+
+class SharedBarCache:
+    """
+    Bar series shared between processes on one host. One process writes the
+    bars it downloads from IB into memory-mapped segments, one per contract,
+    bar size and whatToShow; any other process maps those segments read-only
+    and reads the bars in place instead of downloading them again. Segments
+    live in /dev/shm where available, so they never touch the disk.
+    """
+
+    def __init__(self, directory=None, read_only=False):
+        """
+        Args:
+            directory (str): where the segments live; every process sharing
+                the cache must use the same directory. Defaults to /dev/shm,
+                or the temp directory on systems without it.
+            read_only (bool): if True, this process only reads segments
+        """
+        if directory is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else \
+                tempfile.gettempdir()
+        self.directory = directory
+        self.read_only = read_only
+
+    def _segment_path(self, key, barSizeSetting, whatToShow):
+        """
+        Args:
+            key (tuple): identifies the contract; see Security.cache_key()
+        """
+        barSizeSetting = helper_functions._parse_barSizeSetting(barSizeSetting)
+        name = repr((key, barSizeSetting, whatToShow)).encode()
+        return os.path.join(self.directory,
+            'ibbars_{}'.format(hashlib.sha1(name).hexdigest()[:20]))
+
+    def write(self, key, barSizeSetting, whatToShow, bars, startDateTime,
+        endDateTime):
+        """
+        Publishes bars, replacing any segment already written for the same
+        contract, bar size and whatToShow. The segment is swapped in
+        atomically, so readers holding the old one keep a consistent view.
+        Args:
+            key (tuple): identifies the contract; see Security.cache_key()
+            bars (list): Bar objects, oldest first
+            startDateTime, endDateTime (datetime.datetime): the span the bars
+                cover; timezone-aware
+            others: see Security.get_historical_sma()
+        """
+        if self.read_only:
+            raise Exception("Cannot write to a read-only SharedBarCache")
+        day_bars = bool(bars) and not isinstance(bars[0].datetime, datetime)
+        values = array('d', (len(bars), startDateTime.timestamp(),
+            endDateTime.timestamp(), day_bars))
+        for bar in bars:
+            if day_bars:
+                values.append(bar.datetime.toordinal())
+            else:
+                values.append(bar.datetime.timestamp())
+            values.extend((bar.open, bar.high, bar.low, bar.close, bar.volume))
+
+        path = self._segment_path(key, barSizeSetting, whatToShow)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            values.tofile(f)
+        os.replace(temp_path, path)
+
+    def read(self, key, barSizeSetting, whatToShow, trading_exchange_timezone):
+        """
+        Maps a segment read-only.
+        Args:
+            key (tuple): identifies the contract; see Security.cache_key()
+            trading_exchange_timezone (pytz.tzinfo): the timezone intraday bar
+                datetimes are returned in
+            others: see Security.get_historical_sma()
+        Returns:
+            a SharedBarSeries object, or None if no such segment has been
+            written
+        """
+        path = self._segment_path(key, barSizeSetting, whatToShow)
+        try:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                file_id = segment_file_id(f)
+        except FileNotFoundError:
+            return None
+        return SharedBarSeries(mm, trading_exchange_timezone, path, file_id)
+
+def segment_file_id(f):
+    """
+    Returns (device, inode) of an open segment file. write() swaps in a new
+    file rather than rewriting the old one in place, so the id tells the
+    segment a SharedBarSeries mapped apart from whatever its path holds now.
+    """
+    stat = os.fstat(f.fileno())
+    return (stat.st_dev, stat.st_ino)
+
+class SharedBarSeries:
+    """
+    A read-only view of one shared bar segment. Columns and SMAs are read
+    straight out of the mapped memory, without copying the bars. Call close()
+    when done with it.
+    """
+
+    def __init__(self, mm, trading_exchange_timezone, path=None,
+        file_id=None):
+        """
+        Args:
+            mm (mmap.mmap): the mapped segment
+            trading_exchange_timezone (pytz.tzinfo): see SharedBarCache.read()
+            path (str): the segment's file, so other processes can map it too
+            file_id (tuple): see segment_file_id(); lets other processes check
+                that path still holds the segment mapped here
+        """
+        self._mm = mm
+        self.path = path
+        self.file_id = file_id
+        self._values = memoryview(mm).cast('d')
+        self.trading_exchange_timezone = trading_exchange_timezone
+        self.count = int(self._values[0])
+        self.day_bars = bool(self._values[3])
+
+    @property
+    def covered_start(self):
+        return datetime.fromtimestamp(self._values[1],
+            tz=self.trading_exchange_timezone)
+
+    @property
+    def covered_end(self):
+        return datetime.fromtimestamp(self._values[2],
+            tz=self.trading_exchange_timezone)
+
+    def column(self, name):
+        """
+        Args:
+            name (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', 'VOLUME' or 'DATETIME'
+                (timestamps, or date ordinals for day bars)
+        Returns:
+            memoryview of the column's values, oldest first; a strided view
+            into the segment, not a copy
+        """
+        column = COLUMNS[name.lower()]
+        return self._values[HEADER_LENGTH+column::BAR_LENGTH]
+
+    def count_bars_until(self, endDateTime):
+        """
+        Returns the number of bars (int) that start at or before endDateTime.
+        Scans back from the newest bar, so it's cheap when endDateTime is at
+        or near the end of the segment.
+        Args:
+            endDateTime (datetime.datetime): timezone-aware
+        """
+        if self.day_bars:
+            end = endDateTime.date().toordinal()
+        else:
+            end = endDateTime.timestamp()
+        bar_datetimes = self.column('DATETIME')
+        count = self.count
+        while count > 0 and bar_datetimes[count-1] > end:
+            count -= 1
+        return count
+
+    def calculate_sma(self, length, ohlc='CLOSE', endDateTime=None):
+        """
+        Returns the SMA (float) over the newest length bars, summed in place.
+        Args:
+            length (int): e.g. the 30 in '30-day SMA'
+            ohlc (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', or 'AVG' - 'AVG' takes
+                the high/low average
+            endDateTime (datetime.datetime): optional; bars starting after it
+                are left out
+        """
+        if endDateTime is None:
+            end = self.count
+        else:
+            end = self.count_bars_until(endDateTime)
+        if end < length:
+            raise IndexError("There should be at least {} bars in the shared "
+                "segment but it only holds {}".format(length, end))
+        if ohlc.lower() == 'avg':
+            return (sum(self.column('HIGH')[end-length:end]) +
+                sum(self.column('LOW')[end-length:end]))/2/length
+        return sum(self.column(ohlc)[end-length:end])/length
+
+    def historical_values(self, ohlc, endDateTime=None):
+        """
+        Returns a SharedHistoricalValues view: an iterable of (datetime,
+        value) 2-tuples, newest first, like Security.historical_data, but read
+        from the segment lazily rather than copied out of it
+        """
+        if endDateTime is None:
+            end = self.count
+        else:
+            end = self.count_bars_until(endDateTime)
+        return SharedHistoricalValues(self, ohlc, end)
+
+    def _bar_datetime(self, i):
+        """Returns the datetime (or date, for day bars) of the i-th bar"""
+        value = self._values[HEADER_LENGTH+i*BAR_LENGTH]
+        if self.day_bars:
+            return dtdate.fromordinal(int(value))
+        return datetime.fromtimestamp(value, tz=self.trading_exchange_timezone)
+
+    def bars(self):
+        """Returns a list of Bar objects, oldest first (this one copies)"""
+        bars = []
+        for i in range(self.count):
+            start = HEADER_LENGTH+i*BAR_LENGTH
+            bars.append(Bar(self._bar_datetime(i),
+                *self._values[start+1:start+BAR_LENGTH]))
+        return bars
+
+    def close(self):
+        self._values.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SharedHistoricalValues:
+    """
+    (datetime, value) 2-tuples of a SharedBarSeries, newest first, produced
+    one at a time from the mapped segment. Can be iterated more than once; the
+    segment stays mapped for as long as this object is referenced.
+    """
+
+    def __init__(self, series, ohlc, end):
+        """
+        Args:
+            series (SharedBarSeries): the segment to read
+            ohlc (str): 'OPEN', 'HIGH', 'LOW', 'CLOSE', or 'AVG'
+            end (int): bars from this index on are left out
+        """
+        self.series = series
+        self.ohlc = ohlc.lower()
+        self.end = end
+
+    def __len__(self):
+        return self.end
+
+    def __iter__(self):
+        if self.ohlc == 'avg':
+            highs = self.series.column('HIGH')
+            lows = self.series.column('LOW')
+            for i in range(self.end-1, -1, -1):
+                yield (self.series._bar_datetime(i), (highs[i]+lows[i])/2)
+        else:
+            column = self.series.column(self.ohlc)
+            for i in range(self.end-1, -1, -1):
+                yield (self.series._bar_datetime(i), column[i])
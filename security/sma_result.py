@@ -0,0 +1,38 @@
+from itertools import islice
+
+class SmaResult:
+    """
+    The outcome of a historical SMA calculation. Holds the SMA value along with
+    the window it was calculated over; the bars themselves are not copied, they
+    are exposed lazily through the bars property.
+    """
+
+    def __init__(self, sma, bar_count, window_start, window_end,
+        historical_values):
+        """
+        Args:
+            sma (float): the SMA value
+            bar_count (int): the number of bars the SMA was calculated over
+            window_start (datetime.datetime): start of the historical info span
+            window_end (datetime.datetime): end of the historical info span
+            historical_values (list): list of (datetime, value) tuples sorted
+                newest first; only the first bar_count items are used
+        """
+        self.sma = sma
+        self.bar_count = bar_count
+        self.window_start = window_start
+        self.window_end = window_end
+        self._historical_values = historical_values
+
+    @property
+    def bars(self):
+        """Iterator over the (datetime, value) tuples used, newest first"""
+        return islice(self._historical_values, self.bar_count)
+
+    def __float__(self):
+        return float(self.sma)
+
+    def __repr__(self):
+        return "SmaResult(sma={}, bar_count={}, window_start={}, " \
+            "window_end={})".format(self.sma, self.bar_count,
+            self.window_start, self.window_end)
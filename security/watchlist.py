@@ -0,0 +1,207 @@
+import time, logging, threading
+from collections import deque
+from datetime import datetime
+
+from . import bars as bars_module
+from .security import Security
+
+logger = logging.getLogger(__name__)
+
+#IB counts 6 or more historical data requests for the same contract and
+#whatToShow within 2 seconds as a pacing violation
+SAME_CONTRACT_MAX_REQUESTS = 5
+SAME_CONTRACT_PACING_SECS = 2
+
+class WatchlistEntry:
+    """One SMA being watched; see SmaWatchlist.add()"""
+
+    def __init__(self, security, length, barSizeSetting, ohlc, whatToShow,
+        callback):
+        self.security = security
+        self.length = length
+        self.barSizeSetting = barSizeSetting
+        self.ohlc = ohlc
+        self.whatToShow = whatToShow
+        self.callback = callback
+        self.sma_result = None #the latest SmaResult
+
+class SmaWatchlist:
+    """
+    Keeps the SMAs of many Securities up to date. Each SMA is refreshed right
+    after one of its bars closes, according to the trading calendar set with
+    Security.set_trading_exchange_information(), so only the SMAs whose bar
+    just closed are requested. Requests are spread evenly over IB's
+    historical data pacing period rather than sent in bursts, and outside of
+    trading hours the watchlist sleeps until the first bar close of the next
+    session.
+    """
+
+    def __init__(self, max_requests=60, pacing_period_secs=600,
+        bar_close_delay_secs=2, timeout=30):
+        """
+        Args:
+            max_requests (int): at most this many historical data requests are
+                sent in any pacing_period_secs seconds; IB's limit is 60 per 10
+                minutes
+            pacing_period_secs (float): see max_requests; requests are spaced
+                at least pacing_period_secs/max_requests seconds apart
+            bar_close_delay_secs (float): how long after a bar closes to
+                refresh, giving IB time to finalize the bar
+            timeout (float): passed into Security.get_historical_sma()
+        """
+        self.max_requests = max_requests
+        self.pacing_period_secs = pacing_period_secs
+        self.bar_close_delay_secs = bar_close_delay_secs
+        self.timeout = timeout
+        self.entries_by_barSizeSetting = {}
+        self.next_bar_close_by_barSizeSetting = {}
+        self.pending_entries = deque() #entries waiting to be refreshed
+        self.request_times = deque() #time.time() of recent requests
+        self.request_times_by_contract = {} #(Security.cache_key(),
+            #whatToShow) -> time.time() of recent requests
+
+    def add(self, security, length, barSizeSetting, ohlc, whatToShow,
+        callback):
+        """
+        Args:
+            callback (function): called after every refresh as
+                callback(entry, previous_sma_result, sma_result), where
+                previous_sma_result is None on the first refresh; compare the
+                two to detect crossovers
+            others: see Security.get_historical_sma()
+        Returns:
+            the WatchlistEntry
+        """
+        entry = WatchlistEntry(security, length, barSizeSetting, ohlc,
+            whatToShow, callback)
+        self.entries_by_barSizeSetting.setdefault(barSizeSetting,
+            []).append(entry)
+        self.pending_entries.append(entry) #get an SMA right away
+        return entry
+
+    def run(self, stop_event=None):
+        """
+        Blocks, refreshing SMAs as their bars close, until stop_event is set.
+        Args:
+            stop_event (threading.Event): optional; set it from another thread
+                to stop the watchlist
+        """
+        if stop_event is None:
+            stop_event = threading.Event()
+        while not stop_event.is_set():
+            wait_secs = self.run_once()
+            if wait_secs > 0:
+                stop_event.wait(wait_secs)
+
+    def run_once(self):
+        """
+        Queues the entries whose bar has closed and refreshes as many queued
+        entries as the pacing limit allows.
+        Returns:
+            seconds until there is more work to do (float)
+        """
+        now = datetime.now(tz=Security.trading_exchange_timezone)
+        self._queue_entries_whose_bar_closed(now)
+        while self.pending_entries:
+            wait_secs = self._secs_until_request_allowed(
+                self.pending_entries[0])
+            if wait_secs > 0:
+                return wait_secs
+            self._refresh(self.pending_entries.popleft())
+        now = datetime.now(tz=Security.trading_exchange_timezone)
+        next_refresh = min(self.next_bar_close_by_barSizeSetting.values(),
+            default=None)
+        if next_refresh is None: #empty watchlist
+            return self.pacing_period_secs
+        return max((next_refresh-now).total_seconds() +
+            self.bar_close_delay_secs, 0)
+
+    def _queue_entries_whose_bar_closed(self, now):
+        for barSizeSetting, entries in self.entries_by_barSizeSetting.items():
+            bar_close = self.next_bar_close_by_barSizeSetting.get(
+                barSizeSetting)
+            if bar_close is not None and \
+                (now-bar_close).total_seconds() < self.bar_close_delay_secs:
+                continue #bar hasn't closed yet
+            if bar_close is not None: #not the first pass: the bar just closed
+                for entry in entries:
+                    if entry not in self.pending_entries:
+                        self.pending_entries.append(entry)
+            self.next_bar_close_by_barSizeSetting[barSizeSetting] = \
+                bars_module.next_bar_close(now, barSizeSetting,
+                Security.trading_holidays, Security.exchange_opening_time,
+                Security.exchange_normal_close_time,
+                Security.exchange_early_close_time)
+
+    def _secs_until_request_allowed(self, entry):
+        """
+        Returns 0 if entry can be refreshed now, otherwise the secs until it
+        can. Requests are spaced evenly over the pacing period, and on top of
+        that stay within IB's sliding window limits: max_requests per
+        pacing_period_secs overall, and SAME_CONTRACT_MAX_REQUESTS per
+        SAME_CONTRACT_PACING_SECS for entry's contract.
+        """
+        now = time.time()
+        wait_secs = 0
+        if self.request_times:
+            wait_secs = self.request_times[-1] + \
+                self.pacing_period_secs/self.max_requests - now
+        wait_secs = max(wait_secs, _secs_until_window_has_room(
+            self.request_times, self.max_requests, self.pacing_period_secs,
+            now))
+        contract_request_times = self.request_times_by_contract.get(
+            (entry.security.cache_key(), entry.whatToShow))
+        if contract_request_times is not None:
+            wait_secs = max(wait_secs, _secs_until_window_has_room(
+                contract_request_times, SAME_CONTRACT_MAX_REQUESTS,
+                SAME_CONTRACT_PACING_SECS, now))
+        return max(wait_secs, 0)
+
+    def _record_requests(self, entry, number_of_requests):
+        """Counts number_of_requests requests sent for entry just now"""
+        now = time.time()
+        key = (entry.security.cache_key(), entry.whatToShow)
+        for i in range(number_of_requests):
+            self.request_times.append(now)
+            self.request_times_by_contract.setdefault(key, deque()).append(
+                now)
+        #forget contracts that haven't been requested for a while
+        for key, contract_request_times in list(
+            self.request_times_by_contract.items()):
+            if not contract_request_times or \
+                now-contract_request_times[-1] >= SAME_CONTRACT_PACING_SECS:
+                del self.request_times_by_contract[key]
+
+    def _refresh(self, entry):
+        """
+        A failure is logged and doesn't stop the rest of the watchlist; the
+        entry is tried again at its next bar close. Only requests that
+        actually reached IB, rather than being served from a bar cache, use up
+        pacing slots.
+        """
+        previous_sma_result = entry.sma_result
+        requests_sent = entry.security.historical_requests_sent
+        try:
+            entry.sma_result = entry.security.get_historical_sma(entry.length,
+                entry.barSizeSetting, entry.ohlc, entry.whatToShow,
+                endDateTime='now', return_result=True, timeout=self.timeout)
+        except Exception:
+            logger.exception("Couldn't refresh the %s x %s SMA of %s",
+                entry.length, entry.barSizeSetting, entry.security.symbol)
+            return
+        finally:
+            self._record_requests(entry,
+                entry.security.historical_requests_sent-requests_sent)
+        entry.callback(entry, previous_sma_result, entry.sma_result)
+
+def _secs_until_window_has_room(request_times, max_requests, period_secs, now):
+    """
+    Drops the requests older than period_secs from request_times (deque,
+    oldest first) and returns the secs until fewer than max_requests are left
+    in it, 0 if there already are
+    """
+    while request_times and now-request_times[0] >= period_secs:
+        request_times.popleft()
+    if len(request_times) < max_requests:
+        return 0
+    return request_times[-max_requests]+period_secs-now